@@ -9,47 +9,146 @@ st.set_page_config(
 
 # Importazioni e funzioni di base
 import pandas as pd
-import requests
+import numpy as np
 from datetime import datetime, timedelta
 import os
 import json
+import time
+import hashlib
+import tempfile
+from bisect import bisect_left
 
-# Add thefuzz import for fuzzy matching (senza messaggi di errore visibili)
+# Add rapidfuzz import for fuzzy matching (senza messaggi di errore visibili)
 try:
-    from thefuzz import process as fuzzy_process
+    from rapidfuzz import process as fuzzy_process, fuzz, utils as fuzzy_utils
     FUZZY_AVAILABLE = True
 except ImportError:
     FUZZY_AVAILABLE = False
     
-# Import gspread and service_account (senza messaggi di errore visibili)
-try:
-    import gspread
-    from google.oauth2 import service_account
-    GSPREAD_AVAILABLE = True
-except ImportError:
-    GSPREAD_AVAILABLE = False
-    
-# Funzione per convertire la data in formato italiano
-def format_date_italian(date):
-    return date.strftime("%d/%m/%Y") # Format as dd/mm/yyyy
+# Function to normalize a title for fuzzy matching
+def normalize_title(title):
+    if FUZZY_AVAILABLE:
+        return fuzzy_utils.default_process(title)
+    return title.lower()
+
+# Function to compute the 64-bit character-presence mask of a title
+def title_char_mask(title):
+    mask = 0
+    for c in title:
+        mask |= 1 << (ord(c) & 63)
+    return mask
+
+# Function to compute the character masks of many titles at once
+def build_title_masks(titles):
+    """Vectorized title_char_mask over a list of titles (same bits, computed in NumPy)"""
+    lengths = np.fromiter((len(title) for title in titles), dtype=np.int64, count=len(titles))
+    masks = np.zeros(len(titles), dtype=np.uint64)
+    if not lengths.any():
+        return masks
+    # UTF-32 gives one code point per element, matching ord(c) in title_char_mask
+    codes = np.frombuffer("".join(titles).encode("utf-32-le"), dtype=np.uint32)
+    bits = np.left_shift(np.uint64(1), (codes & 63).astype(np.uint64))
+    # OR-reduce each title's segment (empty titles keep a zero mask)
+    starts = np.cumsum(lengths) - lengths
+    non_empty = lengths > 0
+    masks[non_empty] = np.bitwise_or.reduceat(bits, starts[non_empty])
+    return masks
+
+# Function to find the titles whose mask covers the query mask
+def prefilter_title_masks(title_masks, query_mask):
+    return np.flatnonzero((title_masks & query_mask) == query_mask)
+
+# Queries up to this length are first looked up as title prefixes
+PREFIX_QUERY_MAX_LEN = 3
+
+# Function to build the sorted prefix index of the normalized titles
+def build_prefix_index(normalized_titles):
+    sorted_positions = sorted(range(len(normalized_titles)), key=normalized_titles.__getitem__)
+    sorted_titles = [normalized_titles[i] for i in sorted_positions]
+    return sorted_titles, sorted_positions
+
+# Candidate lists at least this long are scored in parallel
+PARALLEL_SCORING_MIN_CHOICES = 10000
+
+# Function to score normalized choices against a normalized query
+def score_fuzzy_matches(query, choices, limit, score_cutoff):
+    """Return the best (choice, score, index) tuples, like rapidfuzz's process.extract"""
+    if len(choices) >= PARALLEL_SCORING_MIN_CHOICES:
+        # Large catalogs: score on all cores (rapidfuzz releases the GIL),
+        # then keep the best matches in the same order as process.extract
+        scores = fuzzy_process.cdist(
+            [query],
+            choices,
+            scorer=fuzz.WRatio,
+            processor=None,
+            score_cutoff=score_cutoff,
+            workers=-1
+        )[0]
+        best = np.argsort(-scores, kind="stable")[:limit]
+        return [(choices[i], float(scores[i]), i) for i in best if scores[i] >= score_cutoff]
+    # Use rapidfuzz to get matches with scores (returns (title, score, index) tuples)
+    return fuzzy_process.extract(
+        query,
+        choices,
+        scorer=fuzz.WRatio,
+        processor=None,
+        score_cutoff=score_cutoff,
+        limit=limit
+    )
 
 # Function to get fuzzy matches for a search term
-def get_fuzzy_matches(search_term, title_list, limit=5, score_cutoff=50):
-    """Get fuzzy matches for a search term from a list of titles"""
+def get_fuzzy_matches(search_term, title_list, normalized_titles, title_masks=None, prefix_index=None, limit=5, score_cutoff=50):
+    """Get fuzzy matches for a search term from a list of titles (normalized_titles aligned with title_list)"""
+    query = normalize_title(search_term)
+    
+    # Short queries are usually a prefix being typed: if enough titles start
+    # with it, return them directly from the sorted prefix index
+    if prefix_index is not None and 0 < len(query) <= PREFIX_QUERY_MAX_LEN:
+        sorted_titles, sorted_positions = prefix_index
+        lo = bisect_left(sorted_titles, query)
+        hi = bisect_left(sorted_titles, query + "\uffff")
+        if hi - lo >= limit:
+            return [(title_list[sorted_positions[i]], 100) for i in range(lo, lo + limit)]
+    
     if not FUZZY_AVAILABLE:
-        # If thefuzz is not available, fall back to substring matching
-        return [(title, 100) for title in title_list if search_term.lower() in title.lower()][:limit]
+        # If rapidfuzz is not available, fall back to substring matching
+        return [(title_list[i], 100) for i, title in enumerate(normalized_titles) if query in title][:limit]
     
-    # Use thefuzz to get matches with scores
-    matches = fuzzy_process.extractBests(
-        search_term, 
-        title_list, 
-        score_cutoff=score_cutoff,
-        limit=limit
+    # Prefilter: score first only the titles containing every character of the query.
+    # The filter is exact for subsequence matches only: WRatio is edit-distance based,
+    # so a title missing a query character can still outscore the filtered ones.
+    # If the filtered run yields fewer than `limit` matches above score_cutoff the
+    # full list is scored; otherwise the ranking may differ from a full scan.
+    if title_masks is not None and len(title_masks):
+        query_mask = np.uint64(title_char_mask(query))
+        candidates = prefilter_title_masks(title_masks, query_mask)
+        if len(candidates) >= limit:
+            choices = [normalized_titles[i] for i in candidates]
+            matches = score_fuzzy_matches(query, choices, limit, score_cutoff)
+            if len(matches) >= limit:
+                # Map the normalized matches back to the original titles
+                return [(title_list[candidates[index]], score) for _, score, index in matches]
+    
+    matches = score_fuzzy_matches(query, normalized_titles, limit, score_cutoff)
+    # Map the normalized matches back to the original titles
+    return [(title_list[index], score) for _, score, index in matches]
+
+# Cached wrapper of get_fuzzy_matches, keyed by search term and catalog content hash
+# (underscore arguments are not hashed by Streamlit)
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def cached_fuzzy_matches(search_term, catalog_version, _title_list, _normalized_titles, _title_masks, _prefix_index, limit=5, score_cutoff=50):
+    return get_fuzzy_matches(
+        search_term,
+        _title_list,
+        _normalized_titles,
+        _title_masks,
+        _prefix_index,
+        limit=limit,
+        score_cutoff=score_cutoff
     )
-    return matches
 
 # Function to connect to Google Sheets
+# Returns the dict of sheets on success, otherwise the error message (str)
 @st.cache_resource(ttl=3600, show_spinner=False)  # Cache for 1 hour, no spinner
 def connect_to_gsheets():
     # Indica all'utente cosa sta avvenendo
@@ -58,6 +157,10 @@ def connect_to_gsheets():
     try:
         # Utilizza direttamente i secrets di Streamlit
         if "gcp_service_account" in st.secrets:
+            # Import differito: gspread e google-auth servono solo qui
+            import gspread
+            from google.oauth2 import service_account
+            
             credentials = service_account.Credentials.from_service_account_info(
                 st.secrets["gcp_service_account"],
                 scopes=[
@@ -77,8 +180,7 @@ def connect_to_gsheets():
                 spreadsheet = client.open(sheet_name)
             except Exception as e:
                 # Se non esiste, mostra messaggio ma non fallire silenziosamente
-                st.session_state.connection_error = f"Errore: Il foglio '{sheet_name}' non è accessibile. Verificare che esista o che l'account di servizio abbia i permessi necessari."
-                return "SIMULATION_MODE"
+                return f"Errore: Il foglio '{sheet_name}' non è accessibile. Verificare che esista o che l'account di servizio abbia i permessi necessari."
             
             # Memorizza in session state per accessi futuri più rapidi
             st.session_state.gs_client = spreadsheet
@@ -106,8 +208,7 @@ def connect_to_gsheets():
                     st.session_state.connection_message = "Fogli di lavoro creati con successo!"
                 except Exception as e:
                     # Fallback al primo foglio
-                    st.session_state.connection_error = f"Errore nella creazione dei fogli di lavoro: {str(e)}"
-                    return "SIMULATION_MODE"
+                    return f"Errore nella creazione dei fogli di lavoro: {str(e)}"
             
             return {
                 "spreadsheet": spreadsheet,
@@ -116,48 +217,124 @@ def connect_to_gsheets():
             }
         else:
             # Secrets non configurati
-            st.session_state.connection_error = "Le credenziali di servizio non sono configurate nei secrets di Streamlit."
-            return "SIMULATION_MODE"
+            return "Le credenziali di servizio non sono configurate nei secrets di Streamlit."
             
     except Exception as e:
         # Errore di connessione - mostra messaggio esplicito
-        st.session_state.connection_error = f"Errore di connessione: {str(e)}"
-        return "SIMULATION_MODE"
+        return f"Errore di connessione: {str(e)}"
         
-# Function to load song data
-@st.cache_data(ttl=3600, show_spinner=False)  # Cache for 1 hour, no spinner
-def load_songs_data():
+# Function to append rows to a worksheet with a single API call
+def append_rows(connection, sheet_key, rows):
+    """Append a batch of rows to one of the worksheets of the connection (RAW values)"""
+    sheet = connection[sheet_key]
+    connection["spreadsheet"].values_append(
+        f"'{sheet.title}'",
+        params={"valueInputOption": "RAW"},
+        body={"values": rows}
+    )
+
+# Local Parquet copy of the song catalog, reused across restarts for 1 hour
+SONGS_CACHE_PATH = "anagrafica_canti.parquet"
+SONGS_CACHE_TTL = 3600
+# Columns of the song catalog used by the app
+SONGS_COLUMNS = ["titolo", "id_canti", "autore", "url", "link_youtube"]
+
+# Function to read the song catalog CSV (only the columns we use)
+def read_songs_csv(source):
+    try:
+        # pyarrow's multithreaded CSV reader is much faster than the default engine
+        return pd.read_csv(source, engine="pyarrow", usecols=SONGS_COLUMNS, dtype_backend="pyarrow")
+    except ImportError:
+        # pyarrow not installed, use the default engine
+        return pd.read_csv(source, usecols=SONGS_COLUMNS)
+
+# Function to compute a content hash of the catalog, used as key of the caches derived from it
+def build_catalog_version(df):
+    # Order-sensitive: the title indexes are positional
+    row_hashes = pd.util.hash_pandas_object(df[["titolo", "id_canti"]], index=False)
+    return hashlib.sha1(row_hashes.to_numpy().tobytes()).hexdigest()
+
+# Function to read the song catalog (Parquet copy, GitHub or local sample)
+def read_songs_catalog():
     try:
-        # First try to load from GitHub
+        # First try the local Parquet copy if it is fresh enough
+        try:
+            if time.time() - os.path.getmtime(SONGS_CACHE_PATH) < SONGS_CACHE_TTL:
+                return pd.read_parquet(SONGS_CACHE_PATH, columns=SONGS_COLUMNS)
+        except Exception:
+            pass
+        
+        # Then try to load from GitHub
         try:
             csv_url = "https://raw.githubusercontent.com/dennisangemi/hildegard/refs/heads/main/data/anagrafica_canti.csv"
-            df = pd.read_csv(csv_url)
+            df = read_songs_csv(csv_url)
+            # Save a Parquet copy (write to a unique temp file, then rename atomically)
+            tmp_path = None
+            try:
+                with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(SONGS_CACHE_PATH)),
+                    prefix=f"{os.path.basename(SONGS_CACHE_PATH)}.",
+                    suffix=".tmp",
+                    delete=False
+                ) as tmp_file:
+                    tmp_path = tmp_file.name
+                    df.to_parquet(tmp_file, index=False)
+                os.replace(tmp_path, SONGS_CACHE_PATH)
+            except Exception:
+                # Remove the partial temp file, if any
+                if tmp_path and os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
             return df
         except:
             # If GitHub loading fails, try local file
             if os.path.exists("sample_canti.csv"):
-                df = pd.read_csv("sample_canti.csv")
+                df = read_songs_csv("sample_canti.csv")
                 return df
             else:
                 # Return an empty dataframe with the required columns
-                return pd.DataFrame(columns=["titolo", "autore", "url", "link_youtube"])
+                return pd.DataFrame(columns=SONGS_COLUMNS)
     except Exception:
         # Return an empty dataframe with the required columns
-        return pd.DataFrame(columns=["titolo", "id_canti", "autore", "url", "link_youtube"])
+        return pd.DataFrame(columns=SONGS_COLUMNS)
+
+# Function to load song data together with its version (hashed once per load, not per rerun)
+@st.cache_data(ttl=3600, show_spinner=False)  # Cache for 1 hour, no spinner
+def load_songs_data():
+    df = read_songs_catalog()
+    return df, build_catalog_version(df)
+
+# Function to build the title -> song id lookup (shared by all sessions)
+@st.cache_resource(ttl=3600, show_spinner=False)  # Cache for 1 hour, no spinner
+def build_title_to_id(_df, catalog_version):
+    if _df.empty or "id_canti" not in _df.columns:
+        return {}
+    # Skip empty titles, keep the first id for duplicated titles, blank out missing ids
+    unique_titles = _df.dropna(subset=["titolo"]).drop_duplicates(subset="titolo")
+    return {
+        title: ("" if pd.isna(song_id) else song_id)
+        for title, song_id in zip(unique_titles["titolo"], unique_titles["id_canti"])
+    }
+
+# Function to build the fuzzy search indexes of the titles (shared by all sessions)
+@st.cache_resource(ttl=3600, show_spinner=False)  # Cache for 1 hour, no spinner
+def build_title_index(_titles, catalog_version):
+    # Normalized titles, character masks for the prefilter and sorted prefix index
+    norm_titles = [normalize_title(title) for title in _titles]
+    return norm_titles, build_title_masks(norm_titles), build_prefix_index(norm_titles)
         
 # Carica dati canti in silenzio
-songs_df = load_songs_data()
+songs_df, catalog_version = load_songs_data()
+
+# Titoli per la selezione (array NumPy, senza copie in liste Python), esclusi quelli vuoti
+existing_song_titles = songs_df["titolo"].dropna().drop_duplicates().to_numpy(copy=False) if not songs_df.empty else np.array([], dtype=object)
 
-# Converti in liste per la selezione
-existing_song_titles_list = list(songs_df["titolo"].unique()) if not songs_df.empty else []
-existing_song_titles_set = set(existing_song_titles_list)
+# Indici di sola lettura condivisi tra le sessioni
+title_to_id = build_title_to_id(songs_df, catalog_version)
+norm_titles, title_masks, prefix_index = build_title_index(existing_song_titles, catalog_version)
 
 # Precarica la connessione a Google Sheets per velocizzare il form
-try:
-    sheets_connection = connect_to_gsheets()
-except Exception:
-    # Silenziosamente fallisce, riproveremo quando necessario
-    pass
+# (in caso di errore riproviamo al momento dell'invio)
+sheets_connection = connect_to_gsheets()
 
 # Title and description
 st.title("Suggeritore di Canti per Hildegard")
@@ -187,9 +364,6 @@ if 'submission_success' not in st.session_state:
     st.session_state.submission_success = False  # Nuovo flag per tracciare il successo dell'invio
 if 'new_song_title' not in st.session_state:
     st.session_state.new_song_title = ""
-# Initialize song list in session state for dropdown
-if 'song_list' not in st.session_state:
-    st.session_state.song_list = existing_song_titles_list
 # Add a step tracker for multi-page form
 if 'current_step' not in st.session_state:
     st.session_state.current_step = 1
@@ -240,6 +414,8 @@ elif st.session_state.current_step == 2:
         st.session_state.search_term_value = ""
     
     # Use a text input for searching/entering song title
+    # (st.text_input reruns the script only on Enter or blur, not on every keystroke,
+    # and the fuzzy search runs in Step 3: no debounce is needed here)
     search_term = st.text_input(
         "Titolo del canto",
         value=st.session_state.search_term_value,  # Use our separate storage variable
@@ -267,7 +443,16 @@ elif st.session_state.current_step == 3:
     
     if search_term:
         # Get fuzzy matches with scores (limit top 10, minimum score 50)
-        fuzzy_matches = get_fuzzy_matches(search_term, st.session_state.song_list, limit=10, score_cutoff=50)
+        fuzzy_matches = cached_fuzzy_matches(
+            search_term,
+            catalog_version,
+            existing_song_titles,
+            norm_titles,
+            title_masks,
+            prefix_index,
+            limit=10,
+            score_cutoff=50
+        )
         # Extract just the song titles
         filtered_songs = [match[0] for match in fuzzy_matches]
         
@@ -368,8 +553,8 @@ elif st.session_state.current_step == 4:
         if 'connection_message' in st.session_state:
             st.info(st.session_state.connection_message)
             
-        if 'connection_error' in st.session_state:
-            st.error(st.session_state.connection_error)
+        if not isinstance(sheets_connection, dict):
+            st.error(sheets_connection)
             
         with st.form(key="new_song_submission_form"):
             # Fields for new song
@@ -433,8 +618,8 @@ elif st.session_state.current_step == 4:
         if 'connection_message' in st.session_state:
             st.info(st.session_state.connection_message)
             
-        if 'connection_error' in st.session_state:
-            st.error(st.session_state.connection_error)
+        if not isinstance(sheets_connection, dict):
+            st.error(sheets_connection)
             
         with st.form(key="existing_song_submission_form"):
             st.session_state.adequacy_percentage = st.slider(
@@ -515,15 +700,7 @@ if st.session_state.form_submitted:
             # --- Logic to determine final values based on is_new ---
             if not is_new:
                 tipo_suggerimento = "Esistente"
-                try:
-                    if not songs_df.empty and final_song_title in existing_song_titles_set:
-                        if 'id_canti' in songs_df.columns:
-                            song_info = songs_df[songs_df["titolo"] == final_song_title].iloc[0]
-                            song_id = song_info.get('id_canti', "") 
-                            if pd.isna(song_id):
-                                song_id = ""
-                except Exception:
-                    song_id = ""
+                song_id = title_to_id.get(final_song_title, "")
             else:
                 tipo_suggerimento = "Nuovo"
                 song_id = ""
@@ -531,37 +708,14 @@ if st.session_state.form_submitted:
                 final_text_link_for_sheet = final_text_link_input
                 final_audio_link_for_sheet = final_audio_link_input
 
-            # Connect to Google Sheets - nuova implementazione corretta
+            # Riutilizza la connessione a Google Sheets già aperta (cache condivisa);
+            # se era fallita, svuota la cache e riprova una volta
+            if not isinstance(sheets_connection, dict):
+                connect_to_gsheets.clear()
+                sheets_connection = connect_to_gsheets()
+            
             try:
-                # Utilizza direttamente i secrets di Streamlit invece del file creds.json
-                if "gcp_service_account" in st.secrets:
-                    credentials = service_account.Credentials.from_service_account_info(
-                        st.secrets["gcp_service_account"], 
-                        scopes=[
-                            "https://spreadsheets.google.com/feeds",
-                            "https://www.googleapis.com/auth/spreadsheets",
-                            "https://www.googleapis.com/auth/drive.file",
-                            "https://www.googleapis.com/auth/drive"
-                        ]
-                    )
-                    
-                    client = gspread.authorize(credentials)
-                    spreadsheet = client.open("hildegard_form_manual_suggestions")
-                    
-                    # Ottieni i fogli di lavoro
-                    try:
-                        existing_songs_sheet = spreadsheet.worksheet("existing_songs")
-                        new_songs_sheet = spreadsheet.worksheet("new_songs")
-                    except gspread.exceptions.WorksheetNotFound:
-                        # Crea i fogli se non esistono
-                        try:
-                            existing_songs_sheet = spreadsheet.add_worksheet("existing_songs", 1000, 10)
-                            new_songs_sheet = spreadsheet.add_worksheet("new_songs", 1000, 10)
-                        except Exception:
-                            # Usa il primo foglio come fallback
-                            existing_songs_sheet = spreadsheet.get_worksheet(0)
-                            new_songs_sheet = spreadsheet.get_worksheet(0)
-                            
+                if isinstance(sheets_connection, dict):
                     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     selected_date_str = st.session_state.selected_date.strftime("%Y-%m-%d")
                     
@@ -575,8 +729,7 @@ if st.session_state.form_submitted:
                             f"{final_adequacy}%",
                             final_notes
                         ]
-                        # Invia i dati
-                        existing_songs_sheet.append_row(row_to_submit)
+                        sheet_key = "existing_songs_sheet"
                     else:
                         row_to_submit = [
                             timestamp,
@@ -589,8 +742,10 @@ if st.session_state.form_submitted:
                             f"{final_adequacy}%",
                             tipo_suggerimento
                         ]
-                        # Invia i dati
-                        new_songs_sheet.append_row(row_to_submit)
+                        sheet_key = "new_songs_sheet"
+                    
+                    # Invia i dati (RAW: nessuna interpretazione di formule lato server)
+                    append_rows(sheets_connection, sheet_key, [row_to_submit])
                         
                     # Imposta il flag di successo dell'invio
                     st.session_state.submission_success = True
@@ -613,7 +768,7 @@ if st.session_state.form_submitted:
                     st.rerun()
                     
                 else:
-                    st.error("Le credenziali di servizio non sono configurate nei secrets di Streamlit.")
+                    st.error(sheets_connection)
                     st.session_state.form_submitted = False
                     
             except Exception as e: